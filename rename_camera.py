@@ -5,178 +5,616 @@ Usage: python rename_camera.py <camera_name>
 import sys
 import re
 import hashlib
+import mmap
 import os
+import stat
 import subprocess
 import tempfile
 import filecmp
 import shutil
+import pathlib
+import itertools
+import concurrent.futures
+import shlex
+import base64
+import array
+import contextlib
+import dataclasses
+import shelve
+import binascii
+import io
 
+# Characters that are not allowed in a camera name
+_NON_ALPHANUMERIC_RE = re.compile(r'[^A-Z0-9]')
 
-def build_jffs2_from_params(source_dir, output_file, params_string):
-    """Build JFFS2 filesystem using a parameter string"""
-    # Split params_string into individual arguments
-    params_list = params_string.split()
-    
-    cmd = [
-        "wsl", "mkfs.jffs2",
-        "-r", source_dir,
-        "-o", output_file
-    ]
-    
-    # Add the parameter arguments
-    cmd.extend(params_list)
-    
+# Lines in uvc.config that hold the camera name
+_NAME_KEYS_RE = re.compile(rb'^(product_lab|video_name)[^\r\n]*', re.MULTILINE)
+
+
+class WslWorker:
+    """A long-lived bash process in WSL, so commands run without paying WSL startup each time"""
+    SENTINEL = "__WSL_WORKER_RC_"
+
+    def __init__(self):
+        # stderr is folded into stdout per command so a single pipe never fills up unread
+        self.process = subprocess.Popen(["wsl", "bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        # Text mode pipes on Windows send every \n as \r\n, and bash would read each \r as part of the command,
+        # so the pipes are opened as bytes and wrapped here with no newline translation
+        self.stdin = io.TextIOWrapper(self.process.stdin, encoding="utf-8", newline="\n")
+        self.stdout = io.TextIOWrapper(self.process.stdout, encoding="utf-8", errors="replace", newline="\n")
+
+    def run(self, args):
+        """Run a command in the shell and return (returncode, output)"""
+        command = " ".join(shlex.quote(arg) for arg in args)
+        return self._send(f"{command} </dev/null 2>&1; rc=$?")
+
+    def run_to_memory(self, args):
+        """
+        Run a command that writes a file, passing a tmpfs path as its last argument.
+        Returns (returncode, output, data) where data is the contents of the written file.
+        """
+        command = " ".join(shlex.quote(arg) for arg in args)
+        # The file never leaves RAM inside WSL and comes back as one base64 line after the command's output. The
+        # echo starts that line even when the output doesn't end in a newline. The subshell's EXIT trap removes the
+        # file however the script ends, as every build left behind would hold an image in WSL's RAM
+        returncode, output = self._send(f'(out=$(mktemp -p /dev/shm) || exit; trap \'rm -f "$out"\' EXIT; '
+                                        f'{command} "$out" </dev/null 2>&1; rc=$?; echo; base64 -w0 "$out"; '
+                                        f'exit $rc); rc=$?')
+        return self._split_encoded_output(returncode, output)
+
+    @staticmethod
+    def _split_encoded_output(returncode, output):
+        """Split the output of run_to_memory's script into (returncode, output, data)"""
+        output, _, encoded = output.rpartition("\n")
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except binascii.Error:
+            # A garbled payload is a failed build, never an empty image
+            return returncode or -1, f"{output}\nCould not decode the written file", None
+        return returncode, output, data
+
+    def _send(self, script):
+        """Run a script that sets $rc and return (rc, output)"""
+        try:
+            # The extra echo puts the sentinel on its own line even when the output doesn't end in a newline,
+            # and is taken off again below
+            self.stdin.write(f"{script}\necho; echo {self.SENTINEL}$rc\n")
+            self.stdin.flush()
+        except OSError as e:
+            return -1, f"WSL worker is not running: {e}"
+
+        output = []
+        for line in self.stdout:
+            if line.startswith(self.SENTINEL):
+                return int(line[len(self.SENTINEL):]), "".join(output).removesuffix("\n")
+            output.append(line)
+        return -1, "WSL worker exited unexpectedly\n" + "".join(output)
+
+    def close(self):
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+def _start_worker():
+    """Start a WslWorker, or return None when wsl is missing so each command starts WSL itself"""
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            return True
-        else:
-            print(f"Error: {result.stderr}")
-            return False
+        return WslWorker()
     except FileNotFoundError:
-        print("mkfs.jffs2 not found. Install mtd-utils into windows subsystem for linux.")
+        return None
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class JffsParams:
+    """One set of mkfs.jffs2 options. to_argv() is the only place they are turned into arguments"""
+    erase_size: str = "0x20000"
+    page_size: str = "512"
+    pad_size: str | None = "1024KiB"
+    compression: str | None = None
+    endianness: str = "-l"
+    no_cleanmarkers: bool = False
+    cleanmarker_size: str | None = None
+    faketime: bool = False
+    squash: str | None = None  # "all", "uids" or "perms"
+    compr_mode: str | None = None
+    with_xattr: bool = False
+    with_selinux: bool = False
+    with_posix_acl: bool = False
+    devtable: str | None = None
+    disabled_compressor: str | tuple[str, ...] | None = None  # A tuple disables several
+    enable_compressor: str | None = None
+
+    def to_argv(self):
+        """Return the mkfs.jffs2 arguments for these options"""
+        argv = ["-e", self.erase_size, "-s", self.page_size]
+        if self.pad_size:
+            argv.append(f"--pad={self.pad_size}")
+        if self.compression:
+            argv.extend(["-q", self.compression])
+        if self.endianness:
+            argv.append(self.endianness)
+        if self.no_cleanmarkers:
+            argv.append("-n")
+        if self.cleanmarker_size:
+            argv.extend(["-c", self.cleanmarker_size])
+        if self.faketime:
+            argv.append("-f")
+        if self.squash == "all":
+            argv.append("-q")
+        elif self.squash == "uids":
+            argv.append("-U")
+        elif self.squash == "perms":
+            argv.append("-P")
+        if self.compr_mode:
+            argv.append(f"--compression-mode={self.compr_mode}")
+        if self.with_xattr:
+            argv.append("--with-xattr")
+        if self.with_selinux:
+            argv.append("--with-selinux")
+        if self.with_posix_acl:
+            argv.append("--with-posix-acl")
+        if self.devtable and os.path.exists(self.devtable):
+            argv.extend(["-D", self.devtable])
+        disabled = self.disabled_compressor
+        if isinstance(disabled, str):
+            disabled = (disabled,)
+        for compressor in disabled or ():
+            argv.append(f"--disable-compressor={compressor}")
+        if self.enable_compressor:
+            argv.append(f"--enable-compressor={self.enable_compressor}")
+        return argv
+
+    def __str__(self):
+        return " ".join(self.to_argv())
+
+# Erase block and page size of each supported camera's flash, determined from an early grid search
+FLASH_GEOMETRIES = {
+    "nebula": {"erase_size": "0x8000", "page_size": "0x1000"},
+}
+
+# Options every image is built with on top of its flash geometry, also from the grid search
+IMAGE_PARAMS = JffsParams(pad_size="0x100000", endianness="-l", no_cleanmarkers=True, squash="all")
+
+def params_for_target(target):
+    """Return the JffsParams for building an image for one of FLASH_GEOMETRIES"""
+    return dataclasses.replace(IMAGE_PARAMS, **FLASH_GEOMETRIES[target])
+
+def build_jffs2(source_dir, output_file, params=JffsParams(), worker=None):
+    """
+    Build JFFS2 filesystem with the given JffsParams, optionally through a persistent WslWorker.
+    If output_file is None the image is never written to disk, and its bytes are returned instead of True.
+    """
+    cmd = ["wsl", "mkfs.jffs2", "-r", source_dir, *params.to_argv()]
+    image = _build_jffs2_to_memory(cmd + ["-o"], worker)
+    if output_file is None:
+        return image
+    if image is None:
         return False
 
-def build_jffs2(source_dir, output_file, erase_size="0x20000", page_size="512", pad_size="1024KiB", 
-                compression=None, endianness="-l", no_cleanmarkers=False, cleanmarker_size=None,
-                faketime=False, squash_perms=False, squash_uids=False, squash_all=False,
-                compr_mode=None, with_xattr=False, with_selinux=False, with_posix_acl=False, devtable=None,
-                disable_compressor=None, enable_compressor=None):
-    cmd = [
-        "wsl", "mkfs.jffs2",
-        "-r", source_dir,
-        "-o", output_file,
-        "-e", erase_size,
-        "-s", page_size,
-    ]
-    
-    if compression:
-        cmd.extend(["-q", compression])
-    
-    if pad_size:
-        cmd.extend(["-p", pad_size])
-    
-    if endianness:
-        cmd.append(endianness)
-    
-    if no_cleanmarkers:
-        cmd.append("-n")
-    
-    if cleanmarker_size:
-        cmd.extend(["-c", cleanmarker_size])
-    
-    if faketime:
-        cmd.append("-f")
-    
-    if squash_all:
-        cmd.append("-q")
-    elif squash_uids:
-        cmd.append("-U") 
-    elif squash_perms:
-        cmd.append("-P")
-    
-    if compr_mode:
-        cmd.extend(["-m", compr_mode])
-    
-    if with_xattr:
-        cmd.append("--with-xattr")
-    
-    if with_selinux:
-        cmd.append("--with-selinux")
-    
-    if with_posix_acl:
-        cmd.append("--with-posix-acl")
-    
-    if devtable and os.path.exists(devtable):
-        cmd.extend(["-D", devtable])
+    # mkfs.jffs2 only ever writes to RAM, and the finished image is moved into place in one step, so a failed or
+    # interrupted build never leaves a partial image behind
+    temp_file = f"{output_file}.tmp"
+    pathlib.Path(temp_file).write_bytes(image)
+    os.replace(temp_file, output_file)
+    return True
+
+def _build_jffs2_to_memory(cmd, worker=None):
+    """Run an mkfs.jffs2 command ending in -o and return the image bytes, or None if it failed"""
+    if worker:
+        returncode, output, image = worker.run_to_memory(cmd[1:])
+    else:
+        try:
+            result = subprocess.run(cmd + ["/dev/stdout"], capture_output=True)
+        except FileNotFoundError:
+            print("mkfs.jffs2 not found. Install mtd-utils into windows subsystem for linux.")
+            return None
+        returncode, output, image = result.returncode, result.stderr.decode(errors='replace'), result.stdout
 
+    if returncode != 0:
+        print(f"Error: {output}")
+        return None
+    # mkfs.jffs2 never writes an empty image, so one means the image was lost on the way back
+    if not image:
+        print(f"Error: mkfs.jffs2 produced an empty image\n{output}".rstrip())
+        return None
+    return image
+
+def _copy_file_contents(src_fd, dst_fd, size):
+    """Copy size bytes between two open files, letting the kernel move the data where it can"""
+    offset = 0
+    # copy_file_range can reflink on CoW filesystems and never touches userspace
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            return True
+        while offset < size:
+            copied = os.copy_file_range(src_fd, dst_fd, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        while offset < size:
+            sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return
+    except (AttributeError, OSError):
+        pass
+
+    # Neither is available (e.g. Windows), so fall back to a read/write loop with one reused buffer
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    with open(src_fd, 'rb', buffering=0, closefd=False) as fsrc, \
+            open(dst_fd, 'wb', buffering=0, closefd=False) as fdst:
+        while n := fsrc.readinto(buffer):
+            written = 0
+            while written < n:
+                written += fdst.write(view[written:n])
+
+def _copy_regular_file(entry, target):
+    """Copy one file's data, mode and times, taking them from its scandir entry's cached stat"""
+    entry_stat = entry.stat(follow_symlinks=False)
+    with open(entry.path, 'rb') as fsrc, open(target, 'wb') as fdst:
+        _copy_file_contents(fsrc.fileno(), fdst.fileno(), entry_stat.st_size)
+    os.chmod(target, stat.S_IMODE(entry_stat.st_mode))
+    os.utime(target, ns=(entry_stat.st_atime_ns, entry_stat.st_mtime_ns))
+
+def _queue_tree(src, dst, executor, futures, directories, exclude=()):
+    """
+    Create the directories and symlinks under src serially and queue every file copy on the executor.
+    Entries of src named in exclude are skipped, but not entries of the same name further down
+    """
+    os.makedirs(dst, exist_ok=True)
+    directories.append((src, dst))
+    with os.scandir(src) as entries:
+        for entry in entries:
+            if entry.name in exclude:
+                continue
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                _queue_tree(entry.path, target, executor, futures, directories)
+            elif entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+            else:
+                futures.append(executor.submit(_copy_regular_file, entry, target))
+
+def _fast_tree(src, dst, exclude=()):
+    """Copy a directory with os.scandir, copying files on a thread pool and reusing each entry's cached stat"""
+    futures = []
+    directories = []
+    # The copies are mostly syscalls, which release the GIL, so threads overlap them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        _queue_tree(src, dst, executor, futures, directories, exclude)
+        for future in futures:
+            future.result()
+    # Directory times last and deepest first, as creating the entries in them updates them
+    for directory_src, directory_dst in reversed(directories):
+        shutil.copystat(directory_src, directory_dst)
+
+def _link_or_copy(src, dst):
+    """Hard link a file into place, copying it when linking is not possible"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+# robocopy exit codes below this all mean success
+_ROBOCOPY_FAILURE = 8
+
+def _fast_copytree(src, dst, exclude=()):
+    """
+    Copy a directory tree, using multithreaded robocopy on Windows and clonefile on macOS.
+    Entries directly in src that are named in exclude are left out
+    """
+    if sys.platform == "darwin":
+        # cp -c clones every file on APFS, so no data is copied. On Linux copy_file_range already does the same
+        if exclude:
+            os.makedirs(dst, exist_ok=True)
+            sources = [os.path.join(src, name) for name in os.listdir(src) if name not in exclude]
         else:
-            print(f"Error: {result.stderr}")
-            return False
+            sources = [os.path.join(src, "")]
+        try:
+            result = subprocess.run(["cp", "-c", "-pR", *sources, dst],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode == 0:
+                return
+            print("Warning: cloning failed, falling back to a slower copy")
+        except FileNotFoundError:
+            pass
+    elif sys.platform == "win32":
+        try:
+            # A full path given to /XD only excludes that directory, not others of the same name further down
+            excluded = ["/XD", *(os.path.join(src, name) for name in exclude)] if exclude else []
+            result = subprocess.run(["robocopy", src, dst, "/E", "/MT:16", "/NFL", "/NDL", "/NJH", "/NJS", "/NP",
+                                     *excluded], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode < _ROBOCOPY_FAILURE:
+                return
+            print(f"Warning: robocopy failed with code {result.returncode}, falling back to a slower copy")
+        except FileNotFoundError:
+            print("Warning: robocopy not found, falling back to a slower copy")
+
+    _fast_tree(src, dst, exclude)
+
+def _remove_retry(function, path):
+    """Remove one path with os.unlink or os.rmdir, clearing a read-only flag on Windows if that is what stopped it"""
+    try:
+        function(path)
+    except PermissionError:
+        # Only Windows refuses to delete read-only files. A hard link shares its mode with every other link, such as
+        # the file in Firmware, so a linked file is never changed
+        if sys.platform != "win32":
+            raise
+        path_stat = os.stat(path, follow_symlinks=False)
+        if path_stat.st_nlink > 1:
+            raise
+        os.chmod(path, path_stat.st_mode | stat.S_IWRITE)
+        function(path)
+
+def _queue_removals(path, executor, futures, directories):
+    """Queue the removal of every file under path on the executor, and list the directories to remove after"""
+    directories.append(path)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _queue_removals(entry.path, executor, futures, directories)
+            else:
+                futures.append(executor.submit(_remove_retry, os.unlink, entry.path))
+
+def _threaded_rmtree(path):
+    """Remove a directory tree with os.scandir, unlinking its files on a thread pool"""
+    futures = []
+    directories = []
+    # Like the copies in _fast_tree, the removals are syscalls that threads can overlap
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        _queue_removals(path, executor, futures, directories)
+        for future in futures:
+            future.result()
+    # Deepest first, so every directory is empty by the time it is removed
+    for directory in reversed(directories):
+        _remove_retry(os.rmdir, directory)
+
+def _fast_rmtree(path):
+    """Remove a directory tree, mirroring an empty directory over it with robocopy on Windows"""
+    if sys.platform == "win32":
+        with tempfile.TemporaryDirectory() as empty_dir:
+            try:
+                result = subprocess.run(["robocopy", empty_dir, path, "/MIR", "/MT:16",
+                                         "/NFL", "/NDL", "/NJH", "/NJS", "/NP"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if result.returncode < _ROBOCOPY_FAILURE:
+                    os.rmdir(path)
+                    return
+            except OSError:
+                pass
+
+    _threaded_rmtree(path)
+
+def stage_in_wsl_tmpfs(source_dir):
+    """
+    Copy source_dir into a new directory in a tmpfs inside WSL so repeated builds read it from RAM.
+    Returns the WSL path of the copy, or source_dir if it could not be staged.
+    """
+    try:
+        # Every search gets its own directory, so searches running at the same time never remove each other's tree
+        result = subprocess.run(["wsl", "mktemp", "-d", "-p", "/dev/shm", "appfs.dir.XXXXXX"], capture_output=True,
+                                text=True)
+        if result.returncode != 0:
+            print(f"Warning: Could not create a directory in tmpfs: {result.stderr}")
+            return source_dir
+        staged_dir = result.stdout.strip()
+        # -a keeps the timestamps set on the source tree. Only stderr is read, and only on failure
+        result = subprocess.run(["wsl", "cp", "-a", f"{source_dir}/.", staged_dir], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            print(f"Staged {source_dir} at {staged_dir}")
+            return staged_dir
+        print(f"Warning: Could not stage {source_dir} in tmpfs: {result.stderr}")
+        remove_wsl_dir(staged_dir)
     except FileNotFoundError:
-        print("mkfs.jffs2 not found. Install mtd-utils into windows subsystem for linux.")
-        return False
+        print("Warning: wsl not found, building directly from the source directory")
+    return source_dir
+
+def remove_wsl_dir(path):
+    """Remove a directory inside WSL"""
+    try:
+        subprocess.run(["wsl", "rm", "-rf", path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        pass
+
+@contextlib.contextmanager
+def _image_data(image):
+    """Give the contents of an image passed either as a path or as a buffer that is already loaded or mapped"""
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f, _map_file(f) as data:
+            yield data
+    else:
+        yield image
 
 def get_file_hash(filepath):
-    """Calculate SHA256 hash of a file"""
-    hash_sha256 = hashlib.sha256()
+    """Calculate SHA256 hash of a file, or of a buffer holding its contents"""
     try:
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
+        # Hash the whole mapping in one call, so OpenSSL's hardware-accelerated SHA256 runs over one
+        # contiguous buffer with no Python read loop
+        with _image_data(filepath) as data:
+            return hashlib.sha256(data).hexdigest()
     except FileNotFoundError:
         return None
 
-def get_jffs2_dump(filepath):
-    """Get first 20 lines of jffs2dump -c -v output"""
+def _scan_tree(directory, root_dir, manifest):
+    """Add (path, relative path, mode) for everything under directory to manifest, in name order"""
+    with os.scandir(directory) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            mode = entry.stat(follow_symlinks=False).st_mode
+            relative = os.path.relpath(entry.path, root_dir).replace(os.sep, "/")
+            manifest.append((entry.path, relative, mode))
+            if stat.S_ISDIR(mode):
+                _scan_tree(entry.path, root_dir, manifest)
+
+def scan_tree_manifest(root_dir):
+    """
+    Walk root_dir once and return (path, relative path, mode) for everything under it, in a stable order.
+    Pass the result to the helpers that take a manifest so they share one walk of the tree
+    """
+    manifest = []
+    _scan_tree(root_dir, root_dir, manifest)
+    return tuple(manifest)
+
+def get_tree_hash(root_dir, manifest=None):
+    """Hash the names, modes and contents of everything under root_dir, in a stable order"""
+    if manifest is None:
+        manifest = scan_tree_manifest(root_dir)
+    digest = hashlib.blake2b()
+    for path, relative, mode in manifest:
+        digest.update(f"{relative}\0{mode:o}\0".encode())
+        if stat.S_ISLNK(mode):
+            digest.update(os.readlink(path).encode())
+        elif stat.S_ISREG(mode):
+            with open(path, "rb") as f, _map_file(f) as data:
+                digest.update(data)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+def get_build_fingerprint(firmware_dir, formatted_name, params):
+    """Fingerprint what a rename build depends on: the firmware tree's file sizes and times, the name and the options"""
+    digest = hashlib.blake2b()
+    digest.update(f"{formatted_name}\0{params!r}\0".encode())
+    for root, dirs, files in os.walk(firmware_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            file_stat = os.stat(path)
+            relative = os.path.relpath(path, firmware_dir).replace(os.sep, "/")
+            digest.update(f"{relative}\0{file_stat.st_size}\0{file_stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+def _jffs2dump_head_script(filepath, lines, discard_errors=False):
+    """Build a bash script that prints the first lines of jffs2dump -c -v output and stops jffs2dump there"""
+    redirect = " 2>/dev/null" if discard_errors else ""
+    # head exits once it has enough lines, and jffs2dump being killed by the SIGPIPE that follows is not a failure
+    return (f"jffs2dump -c -v {shlex.quote(filepath)}{redirect} | head -n {lines}; "
+            f"rc=${{PIPESTATUS[0]}}; [ $rc -eq 0 ] || [ $rc -eq 141 ]")
+
+def _run_jffs2dump_head(filepath, lines, worker=None):
+    """
+    Return (returncode, stdout, stderr) for the first lines of jffs2dump -c -v output.
+    A worker returns both streams as one, so through a worker jffs2dump's stderr is dropped and comes back empty,
+    leaving stdout the same as it is without one
+    """
+    if worker:
+        script = _jffs2dump_head_script(filepath, lines, discard_errors=True)
+        returncode, output = worker.run(["bash", "-c", script])
+        return returncode, output, ""
+
+    # The script goes in on stdin so Windows never has to quote it
+    result = subprocess.run(["wsl", "bash"], input=_jffs2dump_head_script(filepath, lines),
+                            capture_output=True, text=True)
+    return result.returncode, result.stdout, result.stderr
+
+def get_jffs2_dump(filepath, worker=None):
+    """Get first 20 lines of jffs2dump -c -v output, through a persistent WslWorker if one is given"""
     try:
-        result = subprocess.run(["wsl", "jffs2dump", "-c", "-v", filepath], 
-                              capture_output=True, text=True)
-        if result.returncode == 0:
-            lines = result.stdout.split('\n')[:20]
-            return '\n'.join(lines)
-        else:
-            return None
+        # Only 20 lines are compared, so jffs2dump is stopped after those rather than formatting every node
+        returncode, output, _ = _run_jffs2dump_head(filepath, 20, worker)
     except FileNotFoundError:
         return None
+    if returncode == 0:
+        return '\n'.join(output.split('\n')[:20])
+    return None
 
-def compare_jffs2_dumps(file1, file2):
-    """Compare first 20 lines of jffs2dump output for two files"""
-    dump1 = get_jffs2_dump(file1)
-    dump2 = get_jffs2_dump(file2)
+def compare_jffs2_dumps(file1, file2, dump1=None, worker=None):
+    """Compare first 20 lines of jffs2dump output for two files. Pass dump1 if file1's dump is already known"""
+    if dump1 is None:
+        dump1 = get_jffs2_dump(file1, worker)
+    dump2 = get_jffs2_dump(file2, worker)
     
     if dump1 and dump2:
         return dump1 == dump2
     return False
 
+def _map_file(f):
+    """Map an open file read-only. Empty files cannot be mapped, so they give an empty bytes instead"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return contextlib.nullcontext(b"")
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def count_32bit_differences(data1, data2):
+    """Compare two buffers 32 bits at a time and count differences, as compare_binaries_32bit does for files"""
+    chunk_size = 4  # 32 bits = 4 bytes
+    common = min(len(data1), len(data2))
+    aligned = common - common % chunk_size
+
+    # XOR the buffers as two big integers and count the 32-bit words that came out zero, so the whole scan
+    # runs in C rather than one Python iteration per word
+    xored = int.from_bytes(data1[:aligned], "little") ^ int.from_bytes(data2[:aligned], "little")
+    differences = aligned // chunk_size - array.array("I", xored.to_bytes(aligned, "little")).count(0)
+
+    # The first chunk where the lengths differ counts once for each side that still has data, then stops
+    tail1 = data1[aligned:aligned + chunk_size]
+    tail2 = data2[aligned:aligned + chunk_size]
+    if len(tail1) != len(tail2):
+        differences += bool(tail1) + bool(tail2)
+    elif tail1 != tail2:
+        differences += 1
+    return differences
+
+def _compare_streams_32bit(f1, f2, chunk_size=1024 * 1024):
+    """Count 32-bit differences between two open files, reading large chunks and only scanning those that differ"""
+    differences = 0
+    # Every chunk is read into the same two buffers, so the loop does not allocate per chunk
+    buffer1 = bytearray(chunk_size)
+    buffer2 = bytearray(chunk_size)
+    while True:
+        read1 = f1.readinto(buffer1)
+        read2 = f2.readinto(buffer2)
+        if read1 < chunk_size or read2 < chunk_size:
+            # At least one file has ended, and count_32bit_differences counts where
+            return differences + count_32bit_differences(buffer1[:read1], buffer2[:read2])
+        if buffer1 != buffer2:
+            differences += count_32bit_differences(buffer1, buffer2)
+
 def compare_binaries_32bit(file1, file2):
     """Compare two binary files 32 bits at a time and count differences"""
     try:
         with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
-            differences = 0
-            chunk_size = 4  # 32 bits = 4 bytes
-            
-            while True:
-                chunk1 = f1.read(chunk_size)
-                chunk2 = f2.read(chunk_size)
-                
-                # If one file is shorter, count remaining chunks as different
-                if len(chunk1) != len(chunk2):
-                    if chunk1:
-                        differences += 1
-                    if chunk2:
-                        differences += 1
-                    break
-                
-                # If both chunks are empty, we've reached the end
-                if not chunk1:
-                    break
-                
-                # Compare the 32-bit chunks
-                if chunk1 != chunk2:
-                    differences += 1
-                    
-        return differences
+            try:
+                with _map_file(f1) as data1, _map_file(f2) as data2:
+                    return count_32bit_differences(data1, data2)
+            except (OSError, ValueError):
+                # Not every file can be mapped, e.g. on some network shares
+                return _compare_streams_32bit(f1, f2)
     except FileNotFoundError:
         return float('inf')  # Return infinity if files don't exist
 
-def compare_file_listings(original_file, test_file):
-    """Compare the file listings from both JFFS2 images to check permissions/timestamps"""
+def get_jffs2_listing(filepath):
+    """Get the jffs2dump -c output for an image, or None if it failed"""
+    try:
+        result = subprocess.run(["wsl", "jffs2dump", "-c", filepath], capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    if result.returncode == 0:
+        return result.stdout
+    return None
+
+def compare_file_listings(original_file, test_file, original_listing=None):
+    """
+    Compare the file listings from both JFFS2 images to check permissions/timestamps.
+    Pass original_listing if the original's listing is already known.
+    """
     try:
         # Get file listings from both images
-        result1 = subprocess.run(["wsl", "jffs2dump", "-c", original_file], 
-                               capture_output=True, text=True)
-        result2 = subprocess.run(["wsl", "jffs2dump", "-c", test_file], 
-                               capture_output=True, text=True)
+        if original_listing is None:
+            original_listing = get_jffs2_listing(original_file)
+        test_listing = get_jffs2_listing(test_file)
         
-        if result1.returncode == 0 and result2.returncode == 0:
-            lines1 = result1.stdout.split('\n')
-            lines2 = result2.stdout.split('\n')
+        if original_listing is not None and test_listing is not None:
+            lines1 = original_listing.split('\n')
+            lines2 = test_listing.split('\n')
             
             print(f"\n📁 FILE LISTING COMPARISON:")
             print(f"Original has {len(lines1)} lines, Test has {len(lines2)} lines")
@@ -204,10 +642,9 @@ def compare_file_listings(original_file, test_file):
 def analyze_filesystem_structure(filepath):
     """Analyze the filesystem structure to check for timestamp/permission patterns"""
     try:
-        result = subprocess.run(["wsl", "jffs2dump", "-c", "-v", filepath], 
-                              capture_output=True, text=True)
-        if result.returncode == 0:
-            lines = result.stdout.split('\n')[:50]  # First 50 lines
+        returncode, output, errors = _run_jffs2dump_head(filepath, 50)
+        if returncode == 0:
+            lines = output.split('\n')[:50]  # First 50 lines
             
             print(f"\n🔍 FILESYSTEM ANALYSIS for {filepath}:")
             timestamp_pattern = False
@@ -225,14 +662,38 @@ def analyze_filesystem_structure(filepath):
             
             return {"timestamps": timestamp_pattern, "permissions": permission_pattern}
         else:
-            print(f"Error analyzing {filepath}: {result.stderr}")
+            print(f"Error analyzing {filepath}: {errors}")
             return None
     except Exception as e:
         print(f"Error analyzing filesystem: {e}")
         return None
 
+def _first_difference(data1, data2, block_size=64 * 1024):
+    """Return the offset of the first byte where two buffers differ, or None if they agree over their common length"""
+    common = min(len(data1), len(data2))
+    start = 0
+    # Slice comparisons run as memcmp, so find the first block that differs and then halve it down to one byte
+    while start < common:
+        end = min(start + block_size, common)
+        if data1[start:end] != data2[start:end]:
+            break
+        start = end
+    else:
+        return None
+
+    while end - start > 1:
+        middle = (start + end) // 2
+        if data1[start:middle] == data2[start:middle]:
+            start = middle
+        else:
+            end = middle
+    return start
+
 def extract_and_compare_files(original_jffs2, test_jffs2):
-    """Extract files from both JFFS2 images and compare actual file contents"""
+    """
+    Extract files from both JFFS2 images and compare actual file contents.
+    Either image can be a path or a buffer that is already loaded or mapped.
+    """
     import tempfile
     
     try:
@@ -247,9 +708,8 @@ def extract_and_compare_files(original_jffs2, test_jffs2):
             
             # Extract both filesystems (this might not work with jffs2dump, need alternative)
             # For now, let's compare the raw binary content at different offsets
-            with open(original_jffs2, 'rb') as f1, open(test_jffs2, 'rb') as f2:
-                f1_data = f1.read()
-                f2_data = f2.read()
+            # Files are mapped rather than read, so large images are paged in instead of copied
+            with _image_data(original_jffs2) as f1_data, _image_data(test_jffs2) as f2_data:
                 
                 print(f"Original size: {len(f1_data)} bytes")
                 print(f"Test size: {len(f2_data)} bytes")
@@ -263,39 +723,36 @@ def extract_and_compare_files(original_jffs2, test_jffs2):
                 print(f"Last 1000 bytes match: {last_1000_match}")
                 
                 # Find first difference
-                for i in range(min(len(f1_data), len(f2_data))):
-                    if f1_data[i] != f2_data[i]:
-                        print(f"First difference at byte {i} (0x{i:x})")
-                        print(f"  Original: 0x{f1_data[i]:02x}")
-                        print(f"  Test:     0x{f2_data[i]:02x}")
-                        
-                        # Show context around the difference
-                        start = max(0, i-10)
-                        end = min(len(f1_data), i+10)
-                        print(f"  Context original: {f1_data[start:end].hex()}")
-                        print(f"  Context test:     {f2_data[start:end].hex()}")
-                        break
-                
-                return {"size_match": len(f1_data) == len(f2_data), 
-                       "first_diff_at": i if 'i' in locals() else None}
+                i = _first_difference(f1_data, f2_data)
+                if i is not None:
+                    print(f"First difference at byte {i} (0x{i:x})")
+                    print(f"  Original: 0x{f1_data[i]:02x}")
+                    print(f"  Test:     0x{f2_data[i]:02x}")
+
+                    # Show context around the difference
+                    start = max(0, i-10)
+                    end = min(len(f1_data), i+10)
+                    print(f"  Context original: {f1_data[start:end].hex()}")
+                    print(f"  Context test:     {f2_data[start:end].hex()}")
+
+                return {"size_match": len(f1_data) == len(f2_data),
+                       "first_diff_at": i}
                 
     except Exception as e:
         print(f"Error extracting/comparing files: {e}")
         return None
 
 def create_device_table_with_timestamp(filename, source_dir, timestamp):
-    """Create a device table file with specific timestamp for all files"""
+    """
+    Create a device table file with specific timestamp for all files.
+    This only writes the table. set_timestamps_recursively sets the timestamps on the files themselves
+    """
     try:
         with open(filename, 'w') as f:
             # Walk through the source directory and create entries for all files
             for root, dirs, files in os.walk(source_dir):
                 for file in files:
                     full_path = os.path.join(root, file)
-                    os.utime(full_path, (timestamp, timestamp))
-
-                    # The remainder of this function isn't needed
-                    # The line above (utime) is used to write same time as source image
-
                     rel_path = os.path.relpath(full_path, source_dir)
                     # Normalize path separators for Linux
                     rel_path = "/" + rel_path.replace("\\", "/")
@@ -321,32 +778,29 @@ def create_device_table_with_timestamp(filename, source_dir, timestamp):
         print(f"Error creating device table: {e}")
         return False
 
-def set_timestamps_recursively(root_dir, unix_time):
+def set_timestamps_recursively(root_dir, unix_time, verbose=False, manifest=None):
     """
     Recursively set atime and mtime for all files and directories in root_dir.
     :param root_dir: Path to the directory to update
     :param unix_time: Unix timestamp (int/float) to apply
+    :param verbose: Print every path that is updated, not just failures
+    :param manifest: What scan_tree_manifest returned for root_dir, if it has already been walked
     """
-    for current_root, dirs, files in os.walk(root_dir):
-        # Update files
-        for f in files:
-            fpath = os.path.join(current_root, f)
-            try:
-                os.utime(fpath, (unix_time, unix_time))
-                print(f"Updated file: {fpath}")
-            except Exception as e:
-                print(f"Failed to update file {fpath}: {e}")
-
-        # Update directories too
-        for d in dirs:
-            dpath = os.path.join(current_root, d)
-            try:
-                os.utime(dpath, (unix_time, unix_time))
-                print(f"Updated dir: {dpath}")
-            except Exception as e:
-                print(f"Failed to update dir {dpath}: {e}")
+    if manifest is None:
+        manifest = scan_tree_manifest(root_dir)
+    for path, _, mode in manifest:
+        kind = "dir" if stat.S_ISDIR(mode) else "file"
+        try:
+            os.utime(path, (unix_time, unix_time))
+            if verbose:
+                print(f"Updated {kind}: {path}")
+        except Exception as e:
+            print(f"Failed to update {kind} {path}: {e}")
+
 
 
+# compare_jffs2 needs dump.jffs2, which most systems do not have
+_HAS_DUMP_JFFS2 = shutil.which("dump.jffs2") is not None
 
 def compare_jffs2(img1, img2):
     """
@@ -392,14 +846,175 @@ def compare_jffs2(img1, img2):
         shutil.rmtree(tmpdir2)
 
 
-def scan_for_correct_build_args(source_dir, original_file, test_output_file):
-    """Grid search to find correct build parameters"""
+# Report grid search progress every this many candidates
+PROGRESS_INTERVAL = 64
+
+# Grid search results from earlier runs, so candidates already measured against the same tree are not rebuilt
+GRID_CACHE_FILE = ".gridsearch_cache.db"
+
+def get_mkfs_version():
+    """Return what mkfs.jffs2 --version prints, or an empty string if it cannot be run"""
+    try:
+        result = subprocess.run(["wsl", "mkfs.jffs2", "--version"], capture_output=True, text=True)
+    except FileNotFoundError:
+        return ""
+    return (result.stdout + result.stderr).strip()
+
+def _parse_size(size):
+    """Convert a mkfs.jffs2 size argument such as 0x100000 or 1024KiB into bytes"""
+    for suffix, multiplier in (("KiB", 1024), ("MiB", 1024 * 1024)):
+        if size.endswith(suffix):
+            return int(size[:-len(suffix)], 0) * multiplier
+    return int(size, 0)
+
+def _prune_combinations(combinations, original_size):
+    """Drop combinations mkfs.jffs2 would reject or that build the same image as another combination"""
+    pads = {_parse_size(params.pad_size) for params in combinations if params.pad_size}
+    # An original whose size is a whole number of pads was almost certainly built padded
+    skip_unpadded = any(original_size % pad == 0 for pad in pads)
+
+    # A dict rather than a set so the search order stays deterministic
+    unique = {}
+    for params in combinations:
+        if params.pad_size is None and skip_unpadded:
+            continue
+        # Both of these are passed as -q
+        if params.squash == "all" and params.compression:
+            continue
+        # The cleanmarker size does nothing when cleanmarkers are disabled
+        if params.no_cleanmarkers and params.cleanmarker_size:
+            params = dataclasses.replace(params, cleanmarker_size=None)
+        unique.setdefault(params, None)
+    return list(unique)
+
+# The order parameters are fixed in when probing, most influential first
+_PROBE_ORDER = ("erase_size", "page_size", "compression", "pad_size", "endianness", "no_cleanmarkers",
+                "cleanmarker_size")
+
+def _probe_dimensions(source_dir, original_bytes, axes):
+    """
+    Search one parameter at a time instead of the full grid. Starting from the first option of every axis, each
+    parameter in turn is fixed to the option whose image has the original's size and the fewest 32-bit
+    differences. Returns (params, image) if that ends on an exact match, otherwise None.
+    """
+    worker = _start_worker()
+
+    params = JffsParams(**{key: options[0] for key, options in axes.items()})
+    order = [*_PROBE_ORDER, *(key for key in axes if key not in _PROBE_ORDER)]
+    image = None
+    try:
+        for key in order:
+            if len(axes[key]) == 1:
+                continue
+
+            best = None
+            for option in axes[key]:
+                candidate = dataclasses.replace(params, **{key: option})
+                candidate_image = build_jffs2(source_dir, None, candidate, worker)
+                if candidate_image is None or len(candidate_image) != len(original_bytes):
+                    continue
+                differences = count_32bit_differences(original_bytes, candidate_image)
+                if best is None or differences < best[0]:
+                    best = (differences, candidate, candidate_image)
+
+            if best is None:
+                # Nothing matched the size, so this parameter depends on others that are not fixed yet
+                print(f"Probing {key}: no option matches the original size")
+                return None
+            differences, params, image = best
+            print(f"Probing {key}: {getattr(params, key)} ({differences} 32-bit differences)")
+    finally:
+        if worker:
+            worker.close()
+
+    if image == original_bytes:
+        return params, image
+    return None
+
+def _try_candidate(source_dir, original_file, original_bytes, output_file, params, worker=None,
+                   original_dump=None):
+    """
+    Build one candidate image in memory and measure how close it is to the original.
+    Returns None if the build failed. The image is only written to output_file when it is close enough to be
+    analysed, and only those candidates get their jffs2dump output compared.
+    """
+    image = build_jffs2(source_dir, None, params, worker)
+    if image is None:
+        return None
+
+    if len(image) != len(original_bytes):
+        # A different size can never match, so skip the scan. The estimate ranks every size mismatch below
+        # any same-size candidate, and closer sizes above further ones
+        size_delta = abs(len(image) - len(original_bytes))
+        return {
+            "dumps_match": False,
+            "differences": max(len(image), len(original_bytes)) // 4 + size_delta // 4,
+            "exact": False,
+            "size_mismatch": True,
+        }
+
+    # Wrong parameters change the image almost immediately, so the head rules out nearly every candidate
+    exact = image[:4096] == original_bytes[:4096] and image == original_bytes
+    result = {
+        "dumps_match": False,
+        "differences": count_32bit_differences(original_bytes, image),
+        "exact": exact,
+        "size_mismatch": False,
+    }
+    if result["differences"] < 2000 or exact:
+        pathlib.Path(output_file).write_bytes(image)
+        # Through the same shell as the build, so the dump does not start WSL again
+        result["dumps_match"] = compare_jffs2_dumps(original_file, output_file, original_dump, worker)
+    return result
+
+# Set up in each grid search worker process by _init_trial_process
+_trial_state = {}
+
+def _init_trial_process(source_dir, original_file, original_dump, output_root, output_ext):
+    """Give a grid search worker process its own WSL shell and mapping of the original image"""
+    with open(original_file, 'rb') as f:
+        original_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The shell exits by itself when this process ends and closes its stdin
+    worker = _start_worker()
+    _trial_state.update(source_dir=source_dir, original_file=original_file, original_bytes=memoryview(original_map),
+                        original_dump=original_dump, output_root=output_root, output_ext=output_ext, worker=worker)
+
+def _trial(job):
+    """Evaluate one numbered grid search combination in a worker process"""
+    current, params = job
+
+    # Each candidate gets its own output file so parallel builds never collide
+    output_file = f"{_trial_state['output_root']}-{current}{_trial_state['output_ext']}"
+    result = _try_candidate(_trial_state["source_dir"], _trial_state["original_file"],
+                            _trial_state["original_bytes"], output_file, params, _trial_state["worker"],
+                            _trial_state["original_dump"])
+    return current, params, output_file, result
+
+def scan_for_correct_build_args(source_dir, original_file, test_output_file, verbose=False):
+    """Grid search to find correct build parameters. verbose reports every candidate and timestamp update"""
 
     # Create device table with the specific timestamp (0x8c619565 in hex)
     # create_device_table_with_timestamp("device_table_timestamp.txt", source_dir, "1704288652")
-    set_timestamps_recursively(source_dir, 1704288652)
+    # This is the only place the staged tree's timestamps are set, once before any candidate is built.
+    # It and the hash below share one walk of the tree
+    manifest = scan_tree_manifest(source_dir)
+    set_timestamps_recursively(source_dir, 1704288652, verbose, manifest)
+    # Every timestamp is now the same, so the contents alone identify the tree for the result cache
+    tree_hash = get_tree_hash(source_dir, manifest)
 
-    
+    # Every candidate is built from the same tree, so build from a copy held in RAM
+    build_dir = stage_in_wsl_tmpfs(source_dir)
+    try:
+        return _grid_search(build_dir, original_file, test_output_file, tree_hash, verbose)
+    finally:
+        if build_dir != source_dir:
+            remove_wsl_dir(build_dir)
+
+def _grid_search(source_dir, original_file, test_output_file, tree_hash, verbose=False):
+    """
+    Try every combination of build parameters against the original image.
+    Results are kept in GRID_CACHE_FILE under tree_hash, so a later run over the same tree only builds new combinations
+    """
     # Parameter options to test
     erase_sizes = ["0x8000"]  #, "0x10000", "0x20000", "0x40000", "0x80000"]
     page_sizes = ["0x1000"]  # ["256", "512", "1024", "2048", "4096"]
@@ -418,243 +1033,343 @@ def scan_for_correct_build_args(source_dir, original_file, test_output_file):
     posix_acl_options = [False]  #, True]
     device_table = [None]  # None
     # Try different compression control options that might affect padding/allocation
-    disable_compressors = [None]  # Compressors should be right, "lzo", "zlib", "rtime"]  # zlib is required
+    disable_compressors = [None]  # Compressors should be right, "lzo", "zlib", "rtime", ("lzo", "rtime")]  # zlib is required
     enable_compressors = [None]  # Does not need lzo, and don't need to enable, "lzo", "zlib", "rtime"]
     
-    original_hash = get_file_hash(original_file)
-    if not original_hash:
+    # Every candidate is compared against the original. Map it rather than reading it, so it is opened once here
+    # and the hash and analysis all read the page cache's copy. Both are released when this function returns
+    try:
+        with open(original_file, 'rb') as f:
+            original_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
         print(f"Error: Cannot read original file {original_file}")
         return None
-        
+    original_bytes = memoryview(original_map)
+    original_hash = get_file_hash(original_map)
+
+    # The original's jffs2dump output never changes, so run jffs2dump on it once rather than for every candidate
+    original_dump = get_jffs2_dump(original_file)
+    original_listing = get_jffs2_listing(original_file)
+
     print(f"Original file hash: {original_hash}")
     print("Starting comprehensive grid search...")
     
-    total_combinations = (len(erase_sizes) * len(page_sizes) * len(pad_sizes) * 
-                         len(compressions) * len(endianness_options) * len(cleanmarker_options) *
-                         len(cleanmarker_sizes) * len(faketime_options) * len(squash_options) *
-                         len(compr_modes) * len(xattr_options) * len(selinux_options) * len(posix_acl_options) *
-                         len(device_table) * len(disable_compressors) * len(enable_compressors))
-    current = 0
-    
+    axes = {
+        "erase_size": erase_sizes,
+        "page_size": page_sizes,
+        "pad_size": pad_sizes,
+        "compression": compressions,
+        "endianness": endianness_options,
+        "no_cleanmarkers": cleanmarker_options,
+        "cleanmarker_size": cleanmarker_sizes,
+        "faketime": faketime_options,
+        "squash": squash_options,
+        "compr_mode": compr_modes,
+        "with_xattr": xattr_options,
+        "with_selinux": selinux_options,
+        "with_posix_acl": posix_acl_options,
+        "devtable": device_table,
+        "disabled_compressor": disable_compressors,
+        "enable_compressor": enable_compressors,
+    }
+    combinations = [JffsParams(**dict(zip(axes, values))) for values in itertools.product(*axes.values())]
+    all_combinations = len(combinations)
+    combinations = _prune_combinations(combinations, os.path.getsize(original_file))
+    total_combinations = len(combinations)
+
+    # Probing one parameter at a time only pays off when it needs fewer builds than the full grid, and there is
+    # nothing to probe when every axis has a single option
+    probe_builds = sum(len(options) for options in axes.values() if len(options) > 1)
+    if 0 < probe_builds < total_combinations:
+        print("Probing one parameter at a time...")
+        probed = _probe_dimensions(source_dir, original_bytes, axes)
+        if probed:
+            params, image = probed
+            pathlib.Path(test_output_file).write_bytes(image)
+            print(f"\n🎉 EXACT MATCH FOUND!")
+            print(f"Correct parameters: {params}")
+            return params
+        print("Probing did not find an exact match, falling back to the full grid")
+
+    print(f"Testing {total_combinations} of {all_combinations} combinations after removing redundant ones")
+    output_root, output_ext = os.path.splitext(test_output_file)
+
     # Track closest match
     closest_differences = float('inf')
     closest_params = None
-    closest_combination = None
-    
-    for erase_size in erase_sizes:
-        for page_size in page_sizes:
-            for pad_size in pad_sizes:
-                for compression in compressions:
-                    for endianness in endianness_options:
-                        for no_cleanmarkers in cleanmarker_options:
-                            for cleanmarker_size in cleanmarker_sizes:
-                                for faketime in faketime_options:
-                                    for squash in squash_options:
-                                        for compr_mode in compr_modes:
-                                            for with_xattr in xattr_options:
-                                                for with_selinux in selinux_options:
-                                                    for with_posix_acl in posix_acl_options:
-                                                        for devtable in device_table:
-                                                            for disabled_compressor in disable_compressors:
-                                                                for enable_compressor in enable_compressors:
-                                                                    current += 1
-
-                                                                    # Build parameter description
-                                                                    params = [f"-e {erase_size}", f"-s {page_size}"]
-                                                                    if pad_size:
-                                                                        params.append(f"--pad={pad_size}")
-                                                                    if compression:
-                                                                        params.append(f"-q {compression}")
-                                                                    params.append(endianness)
-                                                                    if no_cleanmarkers:
-                                                                        params.append("-n")
-                                                                    if cleanmarker_size:
-                                                                        params.append(f"-c {cleanmarker_size}")
-                                                                    if faketime:
-                                                                        params.append("-f")
-                                                                    if squash == "all":
-                                                                        params.append("-q")
-                                                                    elif squash == "uids":
-                                                                        params.append("-U")
-                                                                    elif squash == "perms":
-                                                                        params.append("-P")
-                                                                    if compr_mode:
-                                                                        params.append(f"--compression-mode={compr_mode}")
-                                                                    if with_xattr:
-                                                                        params.append("--with-xattr")
-                                                                    if with_selinux:
-                                                                        params.append("--with-selinux")
-                                                                    if with_posix_acl:
-                                                                        params.append("--with-posix-acl")
-                                                                    if devtable and os.path.exists(devtable):
-                                                                        params.append(f"-D {devtable}")
-                                                                    if disabled_compressor:
-                                                                        params.append(f"--disable-compressor={disabled_compressor}")
-                                                                    if enable_compressor:
-                                                                        params.append(f"--enable-compressor={enable_compressor}")
-                                                                    param_str = " ".join(params)
-                                                                    print(f"Testing {current}/{total_combinations}: {param_str}")
-
-                                                                    # Remove previous test file if it exists
-                                                                    if os.path.exists(test_output_file):
-                                                                        os.remove(test_output_file)
-
-                                                                    # Try building with these parameters
-                                                                    success = build_jffs2_from_params(source_dir, test_output_file, param_str)
-
-                                                                    if success:
-                                                                        test_hash = get_file_hash(test_output_file)
-                                                                        dumps_match = compare_jffs2_dumps(original_file, test_output_file)
-                                                                        differences = compare_binaries_32bit(original_file, test_output_file)
-                                                                        dumps_match_v2 = compare_jffs2
-                                                                        if dumps_match_v2:
-                                                                            print("The dumps MATCH")
-                                                                        else:
-                                                                            print("The dumps DO NOT MATCH")
-                                                                        # Check if this is the closest match so far
-                                                                        if differences < closest_differences:
-                                                                            closest_differences = differences
-                                                                            closest_params = param_str
-                                                                            closest_combination = {
-                                                                                "erase_size": erase_size,
-                                                                                "page_size": page_size,
-                                                                                "pad_size": pad_size,
-                                                                                "compression": compression,
-                                                                                "endianness": endianness,
-                                                                                "no_cleanmarkers": no_cleanmarkers,
-                                                                                "cleanmarker_size": cleanmarker_size,
-                                                                                "faketime": faketime,
-                                                                                "squash": squash,
-                                                                                "compr_mode": compr_mode,
-                                                                                "with_xattr": with_xattr,
-                                                                                "with_selinux": with_selinux,
-                                                                                "with_posix_acl": with_posix_acl,
-                                                                                "devtable": devtable
-                                                                            }
-
-                                                                        # Display results
-                                                                        if dumps_match:
-                                                                            print("    ✓ First 20 lines match")
-
-                                                                        print(f"    32-bit differences: {differences} (Closest: {closest_differences})")
-
-                                                                        # If we're getting close (< 2000 differences), do detailed analysis
-                                                                        if differences < 2000:
-                                                                            print(f"    🔍 Close match - analyzing differences...")
-                                                                            compare_file_listings(original_file, test_output_file)
-                                                                            analyze_filesystem_structure(test_output_file)
-                                                                            extract_and_compare_files(original_file, test_output_file)
-
-                                                                        if test_hash and test_hash == original_hash:
-                                                                            print(f"\n🎉 HASH MATCH FOUND!")
-                                                                            print(f"Correct parameters: {param_str}")
-                                                                            return {
-                                                                                "erase_size": erase_size,
-                                                                                "page_size": page_size,
-                                                                                "pad_size": pad_size,
-                                                                                "compression": compression,
-                                                                                "endianness": endianness,
-                                                                                "no_cleanmarkers": no_cleanmarkers,
-                                                                                "cleanmarker_size": cleanmarker_size,
-                                                                                "faketime": faketime,
-                                                                                "squash": squash,
-                                                                                "compr_mode": compr_mode,
-                                                                                "with_xattr": with_xattr,
-                                                                                "with_selinux": with_selinux,
-                                                                                "with_posix_acl": with_posix_acl,
-                                                                                "devtable": devtable
-                                                                            }
-    
+    match = None
+
+    # Results measured with another mkfs.jffs2 release may not hold, so its version is part of every key
+    cache_prefix = f"{tree_hash}:{original_hash}:{get_mkfs_version()}:"
+    with shelve.open(GRID_CACHE_FILE) as cache:
+        pending = []
+        for current, params in enumerate(combinations, 1):
+            cached = cache.get(cache_prefix + repr(params))
+            if cached is None:
+                pending.append((current, params))
+            elif cached["differences"] < closest_differences:
+                closest_differences = cached["differences"]
+                closest_params = params
+        if len(pending) < total_combinations:
+            print(f"Reusing {total_combinations - len(pending)} results from {GRID_CACHE_FILE} "
+                  f"(Closest: {closest_differences})")
+            print(f"Cached candidates are not analysed again. Delete {GRID_CACHE_FILE} to rebuild them")
+
+        # Comparing candidates is pure Python, so use processes rather than threads to keep every core busy
+        with concurrent.futures.ProcessPoolExecutor(initializer=_init_trial_process,
+                                                    initargs=(source_dir, original_file, original_dump,
+                                                              output_root, output_ext)) as executor:
+            for current, params, output_file, result in executor.map(_trial, pending, chunksize=4):
+                # An exact match ends the search and is written out, so only the others are worth remembering
+                if result is not None and not result["exact"]:
+                    cache[cache_prefix + repr(params)] = result
+
+                # Results are reported in order from this process so the output of parallel builds does not interleave.
+                # Unremarkable candidates are only reported every PROGRESS_INTERVAL so printing doesn't slow the search,
+                # unless verbose asks for all of them
+                differences = result["differences"] if result else None
+                notable = result is None or differences < closest_differences or differences < 2000
+                if verbose or notable or current % PROGRESS_INTERVAL == 0 or current == total_combinations:
+                    print(f"Testing {current}/{total_combinations}: {params}")
+                if result is None or not notable:
+                    continue
+
+                # Extracting both images is slow, so only do it for candidates that are nearly identical
+                if _HAS_DUMP_JFFS2 and differences < 100:
+                    try:
+                        dumps_match_v2 = compare_jffs2(original_file, output_file)
+                    except subprocess.CalledProcessError as e:
+                        print(f"Error extracting images: {e}")
+                        dumps_match_v2 = False
+                    if dumps_match_v2:
+                        print("The dumps MATCH")
+                    else:
+                        print("The dumps DO NOT MATCH")
+                # Check if this is the closest match so far
+                if differences < closest_differences:
+                    closest_differences = differences
+                    closest_params = params
+
+                # Display results
+                if result["dumps_match"]:
+                    print("    ✓ First 20 lines match")
+
+                estimated = " (estimated, size differs)" if result["size_mismatch"] else ""
+                print(f"    32-bit differences: {differences}{estimated} (Closest: {closest_differences})")
+
+                # If we're getting close (< 2000 differences), do detailed analysis
+                if differences < 2000:
+                    print(f"    🔍 Close match - analyzing differences...")
+                    compare_file_listings(original_file, output_file, original_listing)
+                    analyze_filesystem_structure(output_file)
+                    extract_and_compare_files(original_map, output_file)
+
+                if result["exact"]:
+                    os.replace(output_file, test_output_file)
+                    executor.shutdown(cancel_futures=True)
+                    print(f"\n🎉 EXACT MATCH FOUND!")
+                    print(f"Correct parameters: {params}")
+                    match = params
+                    match_number = current
+                    break
+
+                # Only close candidates are written out, so there is usually nothing to remove
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(output_file)
+
+    if match:
+        # Candidates that were still building when the match was found finish before the pool closes, and any
+        # close ones among them have written an output file that nothing will read
+        for current, _ in pending:
+            if current > match_number:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(f"{output_root}-{current}{output_ext}")
+        return match
+
     print("\n❌ No matching combination found")
-    
+
     # Print closest match if found
     if closest_params:
         print(f"\n📊 CLOSEST MATCH:")
         print(f"Parameters: {closest_params}")
         print(f"32-bit differences: {closest_differences}")
-        return closest_combination
-    
+        return closest_params
+
     return None
 
+def _rewrite_uvc_config(config_data, formatted_name):
+    """
+    Return the contents of uvc.config with product_lab and video_name set to formatted_name.
+    The config is patched as bytes, so there is no decode/encode round trip and line endings are untouched
+    """
+    name_bytes = formatted_name.encode()
+    return _NAME_KEYS_RE.sub(lambda m: m.group(1).ljust(16) + b":" + name_bytes, config_data)
+
+def launch_usb_download_tool():
+    """Start USBDownloadTool from Firmware-Staging so the new image can be flashed"""
+    usb_tool_path = "Firmware-Staging/USBDownloadTool.exe"
+    if os.path.exists(usb_tool_path):
+        print("Launching USB Download Tool from Firmware-Staging...")
+        try:
+            subprocess.Popen([usb_tool_path], cwd="Firmware-Staging")
+        except:
+            pass
+        print("If it did not open, go into Firmware-Staging and run USBDownloadTool.exe")
+    else:
+        print(f"Warning: USBDownloadTool.exe not found at {usb_tool_path}")
+
+# Where uvc.config ends up once Firmware is staged
+STAGED_CONFIG = os.path.join("Firmware-Staging", "appfs.dir", "config", "uvc.config")
+
+def format_camera_name(camera_name, length_ignore=False):
+    """Uppercase a camera name and keep only alphanumeric characters, exiting if the result can't be used"""
+    formatted_name = _NON_ALPHANUMERIC_RE.sub('', camera_name.upper())
+
+    if not formatted_name:
+        print(f"Error: Camera name {camera_name!r} must contain at least one alphanumeric character")
+        sys.exit(1)
+
+    if len(formatted_name) > 9 and not length_ignore:
+        print("Error: Camera name should probably contain less than 9 characters. If you wish to disable this"
+              " limitation pass the -l or --length-ignore flag")
+        sys.exit(1)
+    return formatted_name
+
+def stage_once(grid_search=False):
+    """Recreate Firmware-Staging from Firmware, exiting if the staged tree has no uvc.config"""
+    # Remove existing Firmware-Staging if it exists. On a first run there is nothing to remove and nothing is started
+    if os.path.isdir("Firmware-Staging"):
+        print("Removing existing Firmware-Staging...")
+        try:
+            _fast_rmtree("Firmware-Staging")
+        except OSError as e:
+            print(f"Warning: Could not remove Firmware-Staging: {e}")
+
+    # Copy Firmware to Firmware-Staging
+    if grid_search:
+        # The grid search rewrites timestamps in the staged tree, so it needs real copies
+        print("Copying Firmware to Firmware-Staging...")
+        _fast_copytree("Firmware", "Firmware-Staging")
+    else:
+        # USBDownloadTool runs from Firmware-Staging and may write its own files there, so everything outside
+        # appfs.dir is copied. appfs.dir is only read by mkfs.jffs2 apart from uvc.config, which is replaced rather
+        # than written through, so it can be linked instead of copied
+        print("Staging Firmware into Firmware-Staging...")
+        _fast_copytree("Firmware", "Firmware-Staging", exclude=("appfs.dir",))
+        shutil.copytree(os.path.join("Firmware", "appfs.dir"), os.path.join("Firmware-Staging", "appfs.dir"),
+                        copy_function=_link_or_copy)
+
+    if not os.path.exists(STAGED_CONFIG):
+        print(f"Error: Config file not found at {STAGED_CONFIG}")
+        sys.exit(1)
+
+def stamp_and_build(formatted_name, output_file, params, worker=None):
+    """Write formatted_name into the staged uvc.config, then build the staged tree into output_file"""
+    # Read the current config and update product_lab and video_name values in one pass
+    config_data = _rewrite_uvc_config(pathlib.Path(STAGED_CONFIG).read_bytes(), formatted_name)
+
+    # Write the updated config. The staged file may be a hard link into Firmware, so replace it
+    # rather than writing through the link
+    os.remove(STAGED_CONFIG)
+    pathlib.Path(STAGED_CONFIG).write_bytes(config_data)
+
+    print(f"Successfully updated {STAGED_CONFIG}")
+    print(f"product_lab and video_name set to: {formatted_name}")
+    return build_jffs2("Firmware-Staging/appfs.dir", output_file, params, worker)
+
+def write_build_stamp(build_stamp, fingerprint, image="Firmware-Staging/appfs.jffs2"):
+    """Record the fingerprint of a finished build together with the hash of the image it produced"""
+    pathlib.Path(build_stamp).write_text(f"{fingerprint}\n{get_file_hash(image)}\n")
+
+def staged_image_matches_stamp(build_stamp, fingerprint, image="Firmware-Staging/appfs.jffs2"):
+    """
+    Check whether the last build had this fingerprint and left its image in place.
+    The staged images can be renamed or replaced by hand after a build, so the image is checked against its hash
+    """
+    try:
+        stamped_fingerprint, stamped_hash = pathlib.Path(build_stamp).read_text().splitlines()
+    except (FileNotFoundError, ValueError):
+        return False
+    return stamped_fingerprint == fingerprint and get_file_hash(image) == stamped_hash
+
+def build_batch(formatted_names, params):
+    """Stage Firmware once and build an image for every name as Firmware-Staging/appfs-<NAME>.jffs2"""
+    stage_once()
+
+    # Every image is built from the same staged tree, so they are built one after another through one WSL shell
+    worker = _start_worker()
+    try:
+        for formatted_name in formatted_names:
+            output_file = f"Firmware-Staging/appfs-{formatted_name}.jffs2"
+            print(f"Creating image for {formatted_name}...")
+            if stamp_and_build(formatted_name, output_file, params, worker):
+                print(f"✅ Saved {output_file}")
+            else:
+                print(f"❌ Could not build an image for {formatted_name}")
+    finally:
+        if worker:
+            worker.close()
+
+    # Put the original config back so the staged tree matches Firmware again
+    os.remove(STAGED_CONFIG)
+    _link_or_copy(os.path.join("Firmware", "appfs.dir", "config", "uvc.config"), STAGED_CONFIG)
+
 def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='Rename camera firmware')
-    parser.add_argument('camera_name', help='Camera name (alphanumeric only)')
+    parser.add_argument('camera_name', nargs='?', help='Camera name (alphanumeric only)')
     parser.add_argument('-g', '--grid-search', action='store_true', 
                        help='Perform grid search to find correct JFFS2 build parameters')
     parser.add_argument('-l', '--length-ignore', action='store_true',
                        help='Allow a camera name to be more than 9 characters (NOT RECOMMENDED)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                       help='Report every grid search candidate instead of only notable ones')
+    parser.add_argument('-t', '--target', choices=sorted(FLASH_GEOMETRIES), default='nebula',
+                       help='Camera whose flash geometry the image is built for (default: nebula)')
+    parser.add_argument('-b', '--batch', metavar='NAMES_FILE',
+                       help='Build an image for every camera name in a file, one per line, instead of renaming one')
     
     args = parser.parse_args()
-    
-    camera_name = args.camera_name
-    
-    # Convert to uppercase and keep only alphanumeric characters
-    formatted_name = re.sub(r'[^A-Z0-9]', '', camera_name.upper())
-    
-    if not formatted_name:
-        print("Error: Camera name must contain at least one alphanumeric character")
-        sys.exit(1)
 
-    if len(formatted_name) > 9 and not args.length_ignore:
-        print("Error: Camera name should probably contain less than 9 characters. If you wish to disable this"
-              " limitation pass the -l or --length-ignore flag")
-        sys.exit(1)
-    
-    print(f"Original name: {camera_name}")
-    print(f"Formatted name: {formatted_name}")
-    
+    if (args.camera_name is None) == (args.batch is None):
+        parser.error("give either a camera name or --batch")
+    if args.batch and args.grid_search:
+        parser.error("--batch can't be combined with --grid-search")
+
     # Check if Firmware directory exists
     if not os.path.exists("Firmware"):
         print("Error: Firmware directory not found")
         sys.exit(1)
+
+    params = params_for_target(args.target)
+
+    if args.batch:
+        with open(args.batch) as f:
+            # Every name is checked before anything is staged. A dict drops repeats but keeps the file's order
+            formatted_names = {format_camera_name(line.strip(), args.length_ignore): None
+                               for line in f if line.strip()}
+        build_batch(list(formatted_names), params)
+        return
+
+    camera_name = args.camera_name
     
-    # Remove existing Firmware-Staging if it exists
-    if os.path.exists("Firmware-Staging"):
-        print("Removing existing Firmware-Staging...")
-        try:
-            result = subprocess.run(["rd", "/s", "/q", "Firmware-Staging"], 
-                                  shell=True, capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Warning: Could not remove Firmware-Staging: {result.stderr}")
-        except Exception as e:
-            print(f"Warning: Could not remove Firmware-Staging: {e}")
-    
-    # Copy Firmware to Firmware-Staging
-    print("Copying Firmware to Firmware-Staging...")
-    shutil.copytree("Firmware", "Firmware-Staging")
-    
-    # Path to the uvc.config file in staging
-    config_path = os.path.join("Firmware-Staging", "appfs.dir", "config", "uvc.config")
-    
-    if not os.path.exists(config_path):
-        print(f"Error: Config file not found at {config_path}")
-        sys.exit(1)
-    
-    # Read the current config
-    with open(config_path, 'r') as f:
-        lines = f.readlines()
-    
-    # Update product_lab and video_name values
-    updated_lines = []
-    for line in lines:
-        if line.startswith('product_lab'):
-            updated_lines.append(f"product_lab     :{formatted_name}\n")
-        elif line.startswith('video_name'):
-            updated_lines.append(f"video_name      :{formatted_name}\n")
-        else:
-            updated_lines.append(line)
+    # Convert to uppercase and keep only alphanumeric characters
+    formatted_name = format_camera_name(camera_name, args.length_ignore)
     
+    print(f"Original name: {camera_name}")
+    print(f"Formatted name: {formatted_name}")
 
-    # Skip if grid search is enabled
+    build_stamp = os.path.join("Firmware-Staging", ".build.stamp")
     if not args.grid_search:
-        # Write the updated config
-        with open(config_path, 'w', newline='\n') as f:
-            f.writelines(updated_lines)
-    
-    print(f"Successfully updated {config_path}")
-    print(f"product_lab and video_name set to: {formatted_name}")
+        # A previous run that built this name from the same Firmware left an identical image behind
+        fingerprint = get_build_fingerprint("Firmware", formatted_name, params)
+        if staged_image_matches_stamp(build_stamp, fingerprint):
+            print("Firmware-Staging already has an image for this name, skipping the rebuild")
+            launch_usb_download_tool()
+            return
+
+    stage_once(args.grid_search)
 
     # Build the jffs2
     input_dir = "Firmware-Staging/appfs.dir"  # os.path.join("Firmware-Staging/appfs.dir")
@@ -663,13 +1378,12 @@ def main():
     # build_jffs2(input_dir, output_file)
 
     if args.grid_search:
+        # The grid search builds the stock image, so the config is left as it is
         print("Performing Grid Search...")
-        scan_for_correct_build_args(input_dir, original_file, output_file)
+        scan_for_correct_build_args(input_dir, original_file, output_file, args.verbose)
     else:
         print("Creating new image in Firmware-Staging...")
-        # Params were determined from an early grid search
-        params = "-e 0x8000 -s 0x1000 --pad=0x100000 -l -n -q"
-        build_jffs2_from_params(input_dir, output_file, params)
+        built = stamp_and_build(formatted_name, output_file, params)
 
         # Rename the images
         old_image = "Firmware-Staging/appfs-old.jffs2"
@@ -687,18 +1401,12 @@ def main():
             print(f"Renamed {new_image} to {original}")
         
         print("✅ Image creation complete!")
-        
-        # Launch USB Download Tool
-        usb_tool_path = "Firmware-Staging/USBDownloadTool.exe"
-        if os.path.exists(usb_tool_path):
-            print("Launching USB Download Tool from Firmware-Staging...")
-            try:
-                subprocess.Popen([usb_tool_path], cwd="Firmware-Staging")
-            except:
-                pass
-            print("If it did not open, go into Firmware-Staging and run USBDownloadTool.exe")
-        else:
-            print(f"Warning: USBDownloadTool.exe not found at {usb_tool_path}")
+
+        # Lets the next run with the same name and Firmware skip straight to flashing
+        if built:
+            write_build_stamp(build_stamp, fingerprint)
+
+        launch_usb_download_tool()
 
 
 
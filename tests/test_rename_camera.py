@@ -0,0 +1,426 @@
+import contextlib
+import filecmp
+import io
+import itertools
+import os
+import pathlib
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rename_camera
+
+
+def baseline_32bit_differences(data1, data2):
+    """The original 4-bytes-at-a-time comparison, which count_32bit_differences must agree with"""
+    f1, f2 = io.BytesIO(data1), io.BytesIO(data2)
+    differences = 0
+    while True:
+        chunk1 = f1.read(4)
+        chunk2 = f2.read(4)
+        if len(chunk1) != len(chunk2):
+            if chunk1:
+                differences += 1
+            if chunk2:
+                differences += 1
+            break
+        if not chunk1:
+            break
+        if chunk1 != chunk2:
+            differences += 1
+    return differences
+
+
+def mutate(rng, data, count):
+    """Return a copy of data with count random bytes changed"""
+    data = bytearray(data)
+    for _ in range(count):
+        if data:
+            position = rng.randrange(len(data))
+            data[position] ^= rng.randrange(1, 256)
+    return bytes(data)
+
+
+class Compare32BitTests(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1704288652)
+
+    def pairs(self):
+        """Yield buffer pairs covering equal, changed, uneven and empty inputs"""
+        yield b"", b""
+        yield b"", b"\x01"
+        yield b"\x01\x02\x03", b""
+        for length1 in range(10):
+            for length2 in range(10):
+                base = self.rng.randbytes(max(length1, length2))
+                yield base[:length1], mutate(self.rng, base, self.rng.randrange(3))[:length2]
+        for _ in range(20):
+            base = self.rng.randbytes(self.rng.randrange(1, 5000))
+            other = mutate(self.rng, base, self.rng.randrange(50))
+            yield base, other[:len(other) - self.rng.randrange(8)]
+
+    def test_count_matches_baseline(self):
+        for data1, data2 in self.pairs():
+            with self.subTest(len1=len(data1), len2=len(data2)):
+                self.assertEqual(rename_camera.count_32bit_differences(data1, data2),
+                                 baseline_32bit_differences(data1, data2))
+
+    def test_streams_match_baseline(self):
+        for data1, data2 in self.pairs():
+            for chunk_size in (4, 8, 12, 1024):
+                with self.subTest(len1=len(data1), len2=len(data2), chunk_size=chunk_size):
+                    differences = rename_camera._compare_streams_32bit(io.BytesIO(data1), io.BytesIO(data2),
+                                                                       chunk_size)
+                    self.assertEqual(differences, baseline_32bit_differences(data1, data2))
+
+    def test_files_match_baseline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file1 = os.path.join(directory, "one.jffs2")
+            file2 = os.path.join(directory, "two.jffs2")
+            for data1, data2 in self.pairs():
+                with open(file1, "wb") as f:
+                    f.write(data1)
+                with open(file2, "wb") as f:
+                    f.write(data2)
+                with self.subTest(len1=len(data1), len2=len(data2)):
+                    self.assertEqual(rename_camera.compare_binaries_32bit(file1, file2),
+                                     baseline_32bit_differences(data1, data2))
+            self.assertEqual(rename_camera.compare_binaries_32bit(file1, os.path.join(directory, "missing")),
+                             float("inf"))
+
+
+class FirstDifferenceTests(unittest.TestCase):
+    def test_finds_first_changed_byte(self):
+        data = bytes(range(256)) * 40
+        for position in (0, 1, 3, 4, 4095, 4096, 5000, len(data) - 1):
+            changed = bytearray(data)
+            changed[position] ^= 0xFF
+            # A later difference must not hide the first one
+            changed[-1] ^= 0x0F
+            for block_size in (1, 4, 7, 64 * 1024):
+                with self.subTest(position=position, block_size=block_size):
+                    self.assertEqual(rename_camera._first_difference(data, bytes(changed), block_size), position)
+
+    def test_equal_over_common_length(self):
+        data = bytes(range(256)) * 4
+        self.assertIsNone(rename_camera._first_difference(data, data))
+        self.assertIsNone(rename_camera._first_difference(data, data[:100], block_size=16))
+        self.assertIsNone(rename_camera._first_difference(b"", data))
+
+
+class RewriteUvcConfigTests(unittest.TestCase):
+    def test_sets_both_names_and_keeps_crlf(self):
+        config = b"vendor_id       :0x1234\r\nproduct_lab     :CCX2F3298\r\nvideo_name      :CCX2F3298\r\nfps:30\r\n"
+        self.assertEqual(rename_camera._rewrite_uvc_config(config, "ABC"),
+                         b"vendor_id       :0x1234\r\nproduct_lab     :ABC\r\nvideo_name      :ABC\r\nfps:30\r\n")
+
+    def test_pads_keys_and_keeps_lf(self):
+        config = b"product_lab:OLD NAME WITH SPACES\nvideo_name :X\nother\n"
+        self.assertEqual(rename_camera._rewrite_uvc_config(config, "NEWNAME"),
+                         b"product_lab     :NEWNAME\nvideo_name      :NEWNAME\nother\n")
+
+    def test_other_lines_untouched(self):
+        config = b"# product_lab is below\r\nvideo_name      :OLD"
+        self.assertEqual(rename_camera._rewrite_uvc_config(config, "ABC"),
+                         b"# product_lab is below\r\nvideo_name      :ABC")
+
+
+def fake_worker(stdout):
+    """A worker that replays canned output instead of running bash"""
+    worker = rename_camera.WslWorker.__new__(rename_camera.WslWorker)
+    worker.stdin = io.StringIO()
+    worker.stdout = io.StringIO(stdout)
+    return worker
+
+
+REAL_POPEN = subprocess.Popen
+
+
+def windows_popen(args, **kwargs):
+    """Start bash in place of wsl bash, translating text written to it the way a Windows text mode pipe does"""
+    text = kwargs.pop("text", False) or kwargs.pop("universal_newlines", False)
+    process = REAL_POPEN(["bash"], **kwargs)
+    if text:
+        process.stdin = io.TextIOWrapper(process.stdin, newline="\r\n", write_through=True)
+        process.stdout = io.TextIOWrapper(process.stdout)
+    return process
+
+
+class WslWorkerOutputTests(unittest.TestCase):
+    sentinel = rename_camera.WslWorker.SENTINEL
+
+    def test_run_returns_output_and_code(self):
+        worker = fake_worker(f"hello\nworld\n\n{self.sentinel}0\n")
+        self.assertEqual(worker.run(["echo", "hello world"]), (0, "hello\nworld\n"))
+        self.assertIn("'hello world'", worker.stdin.getvalue())
+
+    def test_run_unterminated_output(self):
+        worker = fake_worker(f"no newline\n{self.sentinel}3\n")
+        self.assertEqual(worker.run(["false"]), (3, "no newline"))
+
+    def test_run_to_memory(self):
+        worker = fake_worker(f"built\n\nQUJD\n{self.sentinel}0\n")
+        self.assertEqual(worker.run_to_memory(["mkfs.jffs2", "-o"]), (0, "built\n", b"ABC"))
+
+    def test_run_to_memory_unterminated_output(self):
+        # mkfs.jffs2 can end its output without a newline, which must not swallow the start of the image
+        worker = fake_worker(f"warning without newline\nQUJD\n{self.sentinel}0\n")
+        self.assertEqual(worker.run_to_memory(["mkfs.jffs2", "-o"]), (0, "warning without newline", b"ABC"))
+
+    def test_run_to_memory_no_output(self):
+        worker = fake_worker(f"\nQUJD\n{self.sentinel}0\n")
+        self.assertEqual(worker.run_to_memory(["mkfs.jffs2", "-o"]), (0, "", b"ABC"))
+
+    def test_garbled_payload_is_a_failure(self):
+        returncode, output, data = rename_camera.WslWorker._split_encoded_output(0, "built\nnot*base64")
+        self.assertNotEqual(returncode, 0)
+        self.assertIsNone(data)
+        self.assertIn("Could not decode", output)
+
+        returncode, _, data = rename_camera.WslWorker._split_encoded_output(2, "failed\nnot*base64")
+        self.assertEqual(returncode, 2)
+        self.assertIsNone(data)
+
+    def test_worker_exiting(self):
+        worker = fake_worker("partial output\n")
+        returncode, output = worker.run(["true"])
+        self.assertEqual(returncode, -1)
+        self.assertIn("partial output", output)
+
+
+@unittest.skipUnless(shutil.which("bash"), "needs bash")
+class WslWorkerShellTests(unittest.TestCase):
+    def setUp(self):
+        with mock.patch("subprocess.Popen", windows_popen):
+            self.worker = rename_camera.WslWorker()
+        self.addCleanup(self.worker.close)
+
+    def test_commands_through_a_crlf_pipe(self):
+        # A \r reaching bash would end up in $rc and leave a stray line in front of the next command's output
+        self.assertEqual(self.worker.run(["echo", "a"]), (0, "a\n"))
+        self.assertEqual(self.worker.run(["echo", "b"]), (0, "b\n"))
+        self.assertEqual(self.worker.run(["bash", "-c", "printf partial; exit 4"]), (4, "partial"))
+        self.assertEqual(self.worker.run(["echo", "c"]), (0, "c\n"))
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "needs /dev/shm")
+    def test_run_to_memory_leaves_nothing_in_tmpfs(self):
+        before = set(os.listdir("/dev/shm"))
+        with tempfile.NamedTemporaryFile() as source:
+            source.write(b"\x85\x19" * 1000)
+            source.flush()
+            returncode, _, data = self.worker.run_to_memory(["cp", source.name])
+        self.assertEqual((returncode, data), (0, b"\x85\x19" * 1000))
+        returncode, _, _ = self.worker.run_to_memory(["false"])
+        self.assertEqual(returncode, 1)
+        self.assertEqual(set(os.listdir("/dev/shm")) - before, set())
+
+
+class BuildStampTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.stamp = os.path.join(directory.name, ".build.stamp")
+        self.image = os.path.join(directory.name, "appfs.jffs2")
+        with open(self.image, "wb") as f:
+            f.write(b"\x85\x19" * 512)
+        rename_camera.write_build_stamp(self.stamp, "fingerprint", self.image)
+
+    def test_matches_the_image_it_built(self):
+        self.assertTrue(rename_camera.staged_image_matches_stamp(self.stamp, "fingerprint", self.image))
+        self.assertFalse(rename_camera.staged_image_matches_stamp(self.stamp, "other", self.image))
+
+    def test_image_moved_away(self):
+        os.rename(self.image, self.image + ".bak")
+        self.assertFalse(rename_camera.staged_image_matches_stamp(self.stamp, "fingerprint", self.image))
+
+    def test_image_replaced(self):
+        with open(self.image, "wb") as f:
+            f.write(b"\x85\x19" * 511)
+        self.assertFalse(rename_camera.staged_image_matches_stamp(self.stamp, "fingerprint", self.image))
+
+    def test_missing_or_old_stamp(self):
+        missing = self.stamp + ".missing"
+        self.assertFalse(rename_camera.staged_image_matches_stamp(missing, "fingerprint", self.image))
+        with open(self.stamp, "w") as f:
+            f.write("fingerprint")
+        self.assertFalse(rename_camera.staged_image_matches_stamp(self.stamp, "fingerprint", self.image))
+
+
+def make_tree(root, files):
+    """Create files under root from a {relative path: contents} dict"""
+    for relative, contents in files.items():
+        path = os.path.join(root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(contents)
+
+
+class RemoveTreeTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.outside = os.path.join(self.root, "outside")
+        self.tree = os.path.join(self.root, "Firmware-Staging")
+        make_tree(self.outside, {"keep.txt": b"keep", "nested/keep.txt": b"keep"})
+        make_tree(self.tree, {"appfs.jffs2": b"image", "appfs.dir/config/uvc.config": b"config",
+                              "appfs.dir/empty/.keep": b""})
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symlinks")
+    def test_does_not_follow_symlinks(self):
+        os.symlink(self.outside, os.path.join(self.tree, "appfs.dir", "linked_dir"), target_is_directory=True)
+        os.symlink(os.path.join(self.outside, "keep.txt"), os.path.join(self.tree, "linked_file"))
+        rename_camera._threaded_rmtree(self.tree)
+        self.assertFalse(os.path.lexists(self.tree))
+        self.assertEqual(sorted(os.listdir(self.outside)), ["keep.txt", "nested"])
+        self.assertTrue(os.path.isfile(os.path.join(self.outside, "nested", "keep.txt")))
+
+    def test_keeps_hard_linked_originals(self):
+        original = os.path.join(self.outside, "keep.txt")
+        os.link(original, os.path.join(self.tree, "appfs.dir", "linked.txt"))
+        rename_camera._fast_rmtree(self.tree)
+        self.assertFalse(os.path.lexists(self.tree))
+        with open(original, "rb") as f:
+            self.assertEqual(f.read(), b"keep")
+
+
+class CopyTreeTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.src = os.path.join(directory.name, "Firmware")
+        self.dst = os.path.join(directory.name, "Firmware-Staging")
+        make_tree(self.src, {"USBDownloadTool.exe": os.urandom(300000), "appfs.dir/bin/run.sh": b"#!/bin/sh\n",
+                             "appfs.dir/config/uvc.config": b"product_lab     :CCX2F3298\r\n",
+                             "tools/appfs.dir/inner.txt": b"inner"})
+        os.chmod(os.path.join(self.src, "appfs.dir", "bin", "run.sh"), 0o755)
+        os.chmod(os.path.join(self.src, "appfs.dir", "config", "uvc.config"), 0o600)
+        for number, (root, dirs, files) in enumerate(os.walk(self.src)):
+            for name in files + dirs:
+                os.utime(os.path.join(root, name), ns=(1704288652_000000000 + number, 1704288652_123456789))
+
+    def assertSameMetadata(self, src, dst):
+        src_stat, dst_stat = os.stat(src, follow_symlinks=False), os.stat(dst, follow_symlinks=False)
+        self.assertEqual(stat.S_IMODE(src_stat.st_mode), stat.S_IMODE(dst_stat.st_mode), dst)
+        self.assertEqual(src_stat.st_mtime_ns, dst_stat.st_mtime_ns, dst)
+
+    def test_copies_contents_mode_and_mtime(self):
+        rename_camera._fast_tree(self.src, self.dst)
+        self.assertEqual(filecmp.dircmp(self.src, self.dst).diff_files, [])
+        for root, dirs, files in os.walk(self.src):
+            for name in files + dirs:
+                src = os.path.join(root, name)
+                dst = os.path.join(self.dst, os.path.relpath(src, self.src))
+                self.assertSameMetadata(src, dst)
+                if name in files:
+                    with open(src, "rb") as f1, open(dst, "rb") as f2:
+                        self.assertEqual(f1.read(), f2.read())
+                    self.assertEqual(os.stat(dst).st_nlink, 1)
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symlinks")
+    def test_copies_symlinks_as_links(self):
+        os.symlink("run.sh", os.path.join(self.src, "appfs.dir", "bin", "start"))
+        rename_camera._fast_tree(self.src, self.dst)
+        self.assertEqual(os.readlink(os.path.join(self.dst, "appfs.dir", "bin", "start")), "run.sh")
+
+    def test_exclude_only_skips_top_level_entries(self):
+        rename_camera._fast_copytree(self.src, self.dst, exclude=("appfs.dir",))
+        self.assertEqual(sorted(os.listdir(self.dst)), ["USBDownloadTool.exe", "tools"])
+        self.assertTrue(os.path.isfile(os.path.join(self.dst, "tools", "appfs.dir", "inner.txt")))
+
+
+class JffsParamsTests(unittest.TestCase):
+    def test_nebula_matches_the_baseline_command(self):
+        params = rename_camera.params_for_target("nebula")
+        self.assertEqual(str(params), "-e 0x8000 -s 0x1000 --pad=0x100000 -l -n -q")
+        self.assertEqual(params.to_argv(), ["-e", "0x8000", "-s", "0x1000", "--pad=0x100000", "-l", "-n", "-q"])
+
+    def test_every_option(self):
+        params = rename_camera.JffsParams(erase_size="0x10000", page_size="2048", pad_size=None, compression="zlib",
+                                          endianness="-b", cleanmarker_size="16", faketime=True, squash="uids",
+                                          compr_mode="size", with_xattr=True, with_selinux=True,
+                                          with_posix_acl=True, devtable="missing_device_table.txt",
+                                          disabled_compressor=("lzo", "rtime"), enable_compressor="zlib")
+        self.assertEqual(params.to_argv(), ["-e", "0x10000", "-s", "2048", "-q", "zlib", "-b", "-c", "16", "-f",
+                                            "-U", "--compression-mode=size", "--with-xattr", "--with-selinux",
+                                            "--with-posix-acl", "--disable-compressor=lzo",
+                                            "--disable-compressor=rtime", "--enable-compressor=zlib"])
+
+    def test_single_disabled_compressor(self):
+        params = rename_camera.JffsParams(pad_size=None, disabled_compressor="lzo", squash="perms")
+        self.assertEqual(str(params), "-e 0x20000 -s 512 -l -P --disable-compressor=lzo")
+
+
+class PruneCombinationsTests(unittest.TestCase):
+    def grid(self, **axes):
+        return [rename_camera.JffsParams(**dict(zip(axes, values))) for values in itertools.product(*axes.values())]
+
+    def test_cleanmarker_size_collapses_without_cleanmarkers(self):
+        combinations = self.grid(no_cleanmarkers=[True, False], cleanmarker_size=[None, "16", "20"])
+        pruned = rename_camera._prune_combinations(combinations, 1048576)
+        self.assertEqual([(params.no_cleanmarkers, params.cleanmarker_size) for params in pruned],
+                         [(True, None), (False, None), (False, "16"), (False, "20")])
+
+    def test_squash_all_is_dropped_with_compression(self):
+        combinations = self.grid(squash=[None, "all", "uids"], compression=[None, "zlib"])
+        pruned = rename_camera._prune_combinations(combinations, 1048576)
+        self.assertEqual([(params.squash, params.compression) for params in pruned],
+                         [(None, None), (None, "zlib"), ("all", None), ("uids", None), ("uids", "zlib")])
+
+    def test_unpadded_dropped_only_when_the_original_is_padded(self):
+        combinations = self.grid(pad_size=[None, "0x100000", "512KiB"])
+        self.assertEqual([params.pad_size for params in rename_camera._prune_combinations(combinations, 2097152)],
+                         ["0x100000", "512KiB"])
+        self.assertEqual([params.pad_size for params in rename_camera._prune_combinations(combinations, 1000000)],
+                         [None, "0x100000", "512KiB"])
+
+
+class BuildBatchTests(unittest.TestCase):
+    config = b"vendor_id       :0x1234\r\nproduct_lab     :CCX2F3298\r\nvideo_name      :CCX2F3298\r\n"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        make_tree("Firmware", {"USBDownloadTool.exe": b"MZ", "appfs.jffs2": b"original image",
+                               "appfs.dir/config/uvc.config": self.config, "appfs.dir/bin/app": b"\x7fELF"})
+        self.built = {}
+
+    def fake_build(self, source_dir, output_file, params, worker=None):
+        """Record the config each image would be built from instead of running mkfs.jffs2"""
+        config = pathlib.Path(source_dir, "config", "uvc.config").read_bytes()
+        self.built[output_file] = config
+        pathlib.Path(output_file).write_bytes(config)
+        return True
+
+    def test_builds_every_name_without_touching_firmware(self):
+        with mock.patch.object(rename_camera, "build_jffs2", self.fake_build), \
+                mock.patch.object(rename_camera, "WslWorker", side_effect=FileNotFoundError), \
+                contextlib.redirect_stdout(io.StringIO()):
+            rename_camera.build_batch(["ABC", "DEF123"], rename_camera.params_for_target("nebula"))
+
+        self.assertEqual(self.built, {
+            "Firmware-Staging/appfs-ABC.jffs2":
+                b"vendor_id       :0x1234\r\nproduct_lab     :ABC\r\nvideo_name      :ABC\r\n",
+            "Firmware-Staging/appfs-DEF123.jffs2":
+                b"vendor_id       :0x1234\r\nproduct_lab     :DEF123\r\nvideo_name      :DEF123\r\n",
+        })
+        # Firmware is never written through a link, and the staged config is put back afterwards
+        self.assertEqual(pathlib.Path("Firmware/appfs.dir/config/uvc.config").read_bytes(), self.config)
+        self.assertEqual(pathlib.Path(rename_camera.STAGED_CONFIG).read_bytes(), self.config)
+        self.assertEqual(pathlib.Path("Firmware/appfs.jffs2").read_bytes(), b"original image")
+        # Only appfs.dir is linked, so nothing written next to the tool can reach Firmware
+        self.assertEqual(os.stat("Firmware-Staging/USBDownloadTool.exe").st_nlink, 1)
+        self.assertTrue(os.path.samefile("Firmware/appfs.dir/bin/app", "Firmware-Staging/appfs.dir/bin/app"))
+
+
+if __name__ == "__main__":
+    unittest.main()